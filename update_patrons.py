@@ -7,20 +7,46 @@ Fetches patron data from Patreon API and updates CSV files
 import os
 import csv
 import json
-import requests
-from datetime import datetime, timedelta
-from typing import List, Dict, Tuple
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Iterable, List, Dict, Tuple
 from dotenv import dotenv_values # <<< NEW: Recommended for environment files
 
+try:
+    import orjson  # Optional: faster JSON parsing/serialization
+except ImportError:
+    orjson = None
+
 # --- Configuration ---
 CONFIG_FILE = '.patreon.env' # <--- NEW: The file you will GitIgnore
 
-PATREON_ACCESS_TOKEN = ''
-CAMPAIGN_ID = ''
-
 # API endpoints
 BASE_URL = 'https://www.patreon.com/api/oauth2/v2'
 
+# Output paths
+DATA_DIR = '_data'
+JSON_PATH = os.path.join(DATA_DIR, 'patrons.json')
+FILES = {
+    'one_month': os.path.join(DATA_DIR, 'one_month_mentions.csv'),
+    'six_months': os.path.join(DATA_DIR, 'six_months_mentions.csv'),
+    'one_year': os.path.join(DATA_DIR, 'one_year_mentions.csv')
+}
+
+# Pledge amount (cents) -> (eligibility window in seconds, category)
+CUTOFF = {
+    300: (30 * 86400, 'one_month'),    # NOTUS: €3.00
+    500: (180 * 86400, 'six_months'),  # ZEPHYRUS: €5.00
+    1500: (365 * 86400, 'one_year'),   # BOREAS: €15.00
+}
+
+# Shared connection pool so paginated requests reuse the same keep-alive connection
+_HTTP = urllib3.PoolManager(
+    maxsize=4,
+    retries=urllib3.Retry(3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+
 # --- NEW FUNCTION: Load Configuration from Local File ---
 def load_config(config_file: str) -> Tuple[str, str]:
     """
@@ -30,91 +56,127 @@ def load_config(config_file: str) -> Tuple[str, str]:
     token = os.environ.get('PATREON_ACCESS_TOKEN', '')
     campaign_id = os.environ.get('PATREON_CAMPAIGN_ID', '')
 
-    # Fallback to local file if not in env
-    if not token or not campaign_id:
-        if os.path.exists(config_file):
-            try:
-                config = dotenv_values(config_file)
-                if not token:
-                    token = config.get('PATREON_ACCESS_TOKEN', '')
-                if not campaign_id:
-                    campaign_id = config.get('PATREON_CAMPAIGN_ID', '')
-            except Exception as e:
-                print(f"Warning: Could not parse configuration from {config_file}: {e}")
+    # Both set (e.g. GitHub Actions): skip the local file entirely
+    if token and campaign_id:
+        return token, campaign_id
+
+    # Fallback to local file if not in env (dotenv_values returns {} for a missing file)
+    try:
+        config = dotenv_values(config_file)
+        if not token:
+            token = config.get('PATREON_ACCESS_TOKEN', '')
+        if not campaign_id:
+            campaign_id = config.get('PATREON_CAMPAIGN_ID', '')
+    except Exception as e:
+        print(f"Warning: Could not parse configuration from {config_file}: {e}")
 
     return token, campaign_id
 # -------------------------------------------------------------------
 
-def get_patrons() -> List[Dict]:
+def get_patrons(token: str, campaign_id: str, http: urllib3.PoolManager) -> List[Dict]:
     """Fetch all patrons from Patreon API"""
-    
-    # Use the global variables which are set in main()
-    global PATREON_ACCESS_TOKEN, CAMPAIGN_ID
 
-    if not PATREON_ACCESS_TOKEN:
+    if not token:
         print("ERROR: PATREON_ACCESS_TOKEN not set.")
         return []
     
-    if not CAMPAIGN_ID:
+    if not campaign_id:
         print("ERROR: PATREON_CAMPAIGN_ID not set.")
         return []
     
     headers = {
-        'Authorization': f'Bearer {PATREON_ACCESS_TOKEN}',
+        'Authorization': f'Bearer {token}',
     }
     
     # The rest of the function remains the same...
     # Fetch campaign members (patrons)
-    url = f'{BASE_URL}/campaigns/{CAMPAIGN_ID}/members'
+    url = f'{BASE_URL}/campaigns/{campaign_id}/members'
     params = {
         'include': 'user',
         'fields[member]': 'full_name,patron_status,last_charge_date,last_charge_status,currently_entitled_amount_cents',
         'fields[user]': 'full_name',
+        'page[count]': 1000,  # API maximum; keeps pagination to one or two requests
     }
 
     
     all_patrons = []
     
     try:
-        while url:
-            # Replaced response = requests.get(url, headers=headers, params=params)
-            # with the following to include a timeout
-            response = requests.get(url, headers=headers, params=params, timeout=15)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            # Process members
-            included_users = {user['id']: user for user in data.get('included', []) if user['type'] == 'user'}
-            
-            for member in data.get('data', []):
-                if member['attributes']['patron_status'] == 'active_patron':
+        # Prefetch the next page on a worker thread while the current one is processed
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            future = executor.submit(http.request, 'GET', url, fields=params, headers=headers, timeout=15)
+            while future:
+                response = future.result()
+                if response.status >= 400:
+                    raise urllib3.exceptions.HTTPError(f"{response.status} error for url: {response.geturl()}")
+                
+                data = orjson.loads(response.data) if orjson else json.loads(response.data)
+                
+                # Check for next page and start fetching it right away
+                url = data.get('links', {}).get('next')
+                future = executor.submit(http.request, 'GET', url, headers=headers, timeout=15) if url else None
+                
+                # Process members
+                name_by_id = {
+                    user['id']: user.get('attributes', {}).get('full_name', 'Anonymous')
+                    for user in data.get('included', []) if user['type'] == 'user'
+                }
+                
+                for member in data.get('data', []):
+                    attrs = member['attributes']
+                    if attrs['patron_status'] != 'active_patron':
+                        continue
                     user_id = member['relationships']['user']['data']['id']
-                    user = included_users.get(user_id, {})
                     
-                    patron_info = {
+                    all_patrons.append({
                         'member_id': member['id'],
-                        'displayed_name': user.get('attributes', {}).get('full_name', 'Anonymous'),
-                        'last_payment_timestamp': member['attributes'].get('last_charge_date', ''),
-                        'pledge_amount_cents': member['attributes'].get('currently_entitled_amount_cents', 0)
-                    }
-
-                    all_patrons.append(patron_info)
-            
-            # Check for next page
-            url = data.get('links', {}).get('next')
-            params = None  # params only needed for first request
+                        'displayed_name': name_by_id.get(user_id, 'Anonymous'),
+                        'last_payment_timestamp': attrs.get('last_charge_date', ''),
+                        'pledge_amount_cents': attrs.get('currently_entitled_amount_cents', 0)
+                    })
         
         print(f"✓ Successfully fetched {len(all_patrons)} active patrons")
         return all_patrons
     
-    except requests.exceptions.RequestException as e:
+    except (urllib3.exceptions.HTTPError, ValueError) as e:
+        # ValueError covers a response body that isn't valid JSON (json/orjson JSONDecodeError)
         print(f"ERROR fetching patrons: {e}")
         return []
 
+def _parse_patreon_ts(s: str) -> datetime:
+    """Parse a Patreon timestamp into a UTC-aware datetime"""
+    # Patreon sends 'YYYY-MM-DDTHH:MM:SS.sss+00:00', so slice the fixed positions directly.
+    # Only UTC suffixes qualify; any other offset goes through the converting fallback below.
+    suffix = s[19:]
+    if (len(s) >= 19 and s[4] == '-' and s[10] == 'T' and s[16] == ':'
+            and (suffix in ('', 'Z', '+00:00')
+                 or suffix.startswith('.') and s.endswith(('Z', '+00:00')))):
+        try:
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                            int(s[11:13]), int(s[14:16]), int(s[17:19]), tzinfo=timezone.utc)
+        except ValueError:
+            pass
+
+    try:
+        dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
+    except ValueError:
+        dt = datetime.strptime(s, '%Y-%m-%d')
+    # Timestamps without an offset are taken as UTC
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
 def categorize_patrons(patrons: List[Dict]) -> Dict[str, List[Dict]]:
     """Categorize patrons by pledge tier and eligibility duration"""
-    now = datetime.now()
+    now = datetime.now(timezone.utc)
+    now_ts = now.timestamp()
+    
+    # Per-duration YYYY-MM-DD date, one day before the cutoff. ISO dates sort lexicographically,
+    # so clearly lapsed rows are rejected without parsing; the margin absorbs any UTC offset.
+    stale_before = {
+        duration: (now - timedelta(seconds=duration + 86400)).strftime('%Y-%m-%d')
+        for duration, _ in CUTOFF.values()
+    }
     
     categories = {
         'one_month': [],
@@ -125,16 +187,8 @@ def categorize_patrons(patrons: List[Dict]) -> Dict[str, List[Dict]]:
     for patron in patrons:
         pledge_cents = patron.get('pledge_amount_cents', 0)
         
-        if pledge_cents == 300: # NOTUS: €3.00
-            duration_days = 30
-            category = 'one_month'
-        elif pledge_cents == 500: # ZEPHYRUS: €5.00
-            duration_days = 180
-            category = 'six_months'
-        elif pledge_cents == 1500: # BOREAS: €15.00
-            duration_days = 365
-            category = 'one_year'
-        else:
+        duration, category = CUTOFF.get(pledge_cents, (None, None))
+        if duration is None:
             print(f"Warning: Unknown pledge amount {pledge_cents} cents for {patron.get('displayed_name')}")
             continue
         
@@ -142,64 +196,68 @@ def categorize_patrons(patrons: List[Dict]) -> Dict[str, List[Dict]]:
         if not last_charge:
             continue
         
+        if (len(last_charge) >= 10 and last_charge[4] == '-' and last_charge[7] == '-'
+                and last_charge[:10] < stale_before[duration]):
+            continue
+        
         try:
             # Parse the date (format: YYYY-MM-DD or ISO format)
-            if 'T' in last_charge:
-                charge_date = datetime.fromisoformat(last_charge.replace('Z', '+00:00'))
-            else:
-                charge_date = datetime.strptime(last_charge, '%Y-%m-%d')
-            
-            eligible_until = charge_date + timedelta(days=duration_days)
-            if eligible_until > now:
-                categories[category].append(patron)
+            charge_date = _parse_patreon_ts(last_charge)
         except (ValueError, TypeError) as e:
             print(f"Warning: Could not parse date for patron {patron.get('displayed_name')}: {last_charge} ({e})")
             continue
+        
+        if charge_date.timestamp() + duration <= now_ts:
+            continue
+        
+        # Cache the CSV date so write_csv doesn't parse it again
+        patron['_date_ymd'] = charge_date.strftime('%Y-%m-%d')
+        patron['_sort_key'] = patron['displayed_name'].casefold()
+        categories[category].append(patron)
     
     # Sort each category alphabetically by displayed_name
     for cat_list in categories.values():
-        cat_list.sort(key=lambda p: p['displayed_name'].lower())
+        cat_list.sort(key=itemgetter('_sort_key'))
     
     return categories
 
 
 def write_csv(filename: str, patrons: List[Dict]):
-    # ... (No changes needed in this function) ...
     """Write patrons to CSV file"""
     fieldnames = ['member_id', 'displayed_name', 'last_payment_timestamp']
     
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    with open(filename, 'w', newline='', encoding='utf-8', buffering=1 << 16) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
         
         for patron in patrons:
-            # Format the date to just YYYY-MM-DD
-            timestamp = patron.get('last_payment_timestamp', '')
-            if 'T' in timestamp:
-                try:
-                    # Added safety check for date parsing
-                    dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                    timestamp = dt.strftime('%Y-%m-%d')
-                except:
-                    pass
-            
-            writer.writerow({
-                'member_id': patron['member_id'],
-                'displayed_name': patron['displayed_name'],
-                'last_payment_timestamp': timestamp
-            })
+            # YYYY-MM-DD date cached by categorize_patrons
+            timestamp = patron.get('_date_ymd') or patron.get('last_payment_timestamp', '')
+            writer.writerow((patron['member_id'], patron['displayed_name'], timestamp))
+
+def _write_json_rows(f: BinaryIO, rows: Iterable[Dict]) -> int:
+    """Stream rows to f as a JSON array (2-space indent, UTF-8); returns the number of rows written"""
+    count = 0
+    f.write(b'[')
+    for row in rows:
+        if orjson:
+            row_bytes = orjson.dumps(row, option=orjson.OPT_INDENT_2)
+        else:
+            row_bytes = json.dumps(row, indent=2, ensure_ascii=False).encode('utf-8')
+        # Nest each object one level inside the array (JSON strings never contain raw newlines)
+        f.write(b',\n  ' if count else b'\n  ')
+        f.write(row_bytes.replace(b'\n', b'\n  '))
+        count += 1
+    f.write(b'\n]' if count else b']')
+    return count
 
 def main():
     """Main function to update patron CSVs"""
-    # Set global configuration variables before calling get_patrons
-    global PATREON_ACCESS_TOKEN, CAMPAIGN_ID
-    
-    # --- NEW: Load Config ---
-    PATREON_ACCESS_TOKEN, CAMPAIGN_ID = load_config(CONFIG_FILE)
+    os.makedirs(DATA_DIR, exist_ok=True)
     
     print("🔄 Fetching patron data from Patreon API...")
     
-    patrons = get_patrons()
+    patrons = get_patrons(*load_config(CONFIG_FILE), http=_HTTP)
     
     if not patrons:
         print("⚠️  No patrons found or API request failed.")
@@ -209,53 +267,40 @@ def main():
         print("   PATREON_CAMPAIGN_ID='your_campaign_id'")
 
         # Ensure an empty patrons.json exists so downstream steps don't fail
-        data_dir = '_data'
-        os.makedirs(data_dir, exist_ok=True)
-        json_path = os.path.join(data_dir, 'patrons.json')
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump([], f, indent=2, ensure_ascii=False)
-        print(f"✓ Generated {json_path} (empty)")
+        with open(JSON_PATH, 'wb') as f:
+            _write_json_rows(f, [])
+        print(f"✓ Generated {JSON_PATH} (empty)")
         return
     
     print("📊 Categorizing patrons by subscription length...")
     categories = categorize_patrons(patrons)
     
-    # Define file paths
-    data_dir = '_data'
-    os.makedirs(data_dir, exist_ok=True)
-    
-    files = {
-        'one_month': os.path.join(data_dir, 'one_month_mentions.csv'),
-        'six_months': os.path.join(data_dir, 'six_months_mentions.csv'),
-        'one_year': os.path.join(data_dir, 'one_year_mentions.csv')
+    tier_names = {
+        'one_month': 'NOTUS',
+        'six_months': 'ZEPHYRUS',
+        'one_year': 'BOREAS'
     }
     
     # Write CSV files
-    for category, filepath in files.items():
+    for category, filepath in FILES.items():
         patron_list = categories[category]
         write_csv(filepath, patron_list)
         print(f"✓ Updated {filepath} with {len(patron_list)} patrons")
-
-    # Generate patrons.json for client-side auth/perks lookup
-    tier_names = {
-        'one_month': 'NOTUS',
-        'six_months': 'ZEPHYRUS',
-        'one_year': 'BOREAS'
-    }
-    all_patrons_data = []
-    for category, patron_list in categories.items():
-        for patron in patron_list:
-            all_patrons_data.append({
-                'member_id': patron['member_id'],
-                'displayed_name': patron['displayed_name'],
-                'tier': tier_names[category],
-                'last_payment_timestamp': patron['last_payment_timestamp']
-            })
     
-    json_path = os.path.join(data_dir, 'patrons.json')
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(all_patrons_data, f, indent=2, ensure_ascii=False)
-    print(f"✓ Generated {json_path} with {len(all_patrons_data)} patrons")
+    # Stream patrons.json for client-side auth/perks lookup (keeps the full API timestamp)
+    json_rows = (
+        {
+            'member_id': patron['member_id'],
+            'displayed_name': patron['displayed_name'],
+            'tier': tier_names[category],
+            'last_payment_timestamp': patron['last_payment_timestamp']
+        }
+        for category, patron_list in categories.items()
+        for patron in patron_list
+    )
+    with open(JSON_PATH, 'wb', buffering=1 << 16) as json_file:
+        json_count = _write_json_rows(json_file, json_rows)
+    print(f"✓ Generated {JSON_PATH} with {json_count} patrons")
 
     print(f"\n✅ All patron data updated successfully!")
     print(f"   • One Year+: {len(categories['one_year'])} patrons")